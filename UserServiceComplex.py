@@ -1,9 +1,26 @@
 # src/user_service/app/services/user_service.py
-import uuid
-import json
-from datetime import datetime, timedelta
+import os
+import logging
+from datetime import timedelta
+# Module-level aliases save the attribute lookups on the hot create/update paths
+from datetime import datetime as _dt
+from uuid import uuid4 as _uuid4
 import newrelic.agent # For potential APM integration
 
+try:
+    import orjson # Faster serialization for AMQP payloads
+
+    def _orjson_dumps(obj):
+        # stdlib json accepts non-str dict keys, keep accepting them
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+except ImportError:
+    from json import dumps as _orjson_dumps
+from kombu.serialization import register as register_serializer
+
+from eventlet import sleep
+from eventlet.event import Event
+from eventlet.queue import Queue
+
 from nameko.rpc import rpc, RpcProxy
 from nameko.events import event_handler, EventDispatcher, SINGLETON, BROADCAST
 from nameko.dependency_providers import Config
@@ -16,6 +33,65 @@ from dots.providers.logger_provider import LoggerProvider
 from dots.providers.sequoia_metrics import SequoiaMetrics
 from dots.exceptions import NotFound, BadRequest, Conflict
 
+log = logging.getLogger(__name__)
+
+# Register orjson as a Kombu serializer so that events (and RPC payloads)
+# are encoded with it once `serializer: orjson` is set in config/app.yml.
+# No decoder is passed: Kombu keys decoders by content type, so registering
+# one would replace the process-wide `application/json` decoder. Inbound
+# messages and RPC replies keep using stdlib json.
+# Unlike stdlib json, orjson refuses ints outside the 64-bit range.
+# This would normally live in the service bootstrap module.
+register_serializer(
+    'orjson', _orjson_dumps, None,
+    content_type='application/json', content_encoding='utf-8'
+)
+
+# Only wrap entrypoints in a New Relic transaction when the agent is
+# configured, either through the environment or a newrelic.ini; decided once
+# at import so unmonitored deployments pay nothing per call
+_NEW_RELIC_ENABLED = bool(
+    os.environ.get('NEW_RELIC_LICENSE_KEY') or os.environ.get('NEW_RELIC_CONFIG_FILE')
+)
+_bg = newrelic.agent.background_task() if _NEW_RELIC_ENABLED else (lambda f: f)
+
+_CK_PREFIX = "user:"
+_CK_SUFFIX = ":profile"
+
+
+def _user_cache_key(uid):
+    """ Redis key of the cached profile hash for a user id """
+    return _CK_PREFIX + uid + _CK_SUFFIX
+
+
+class User:
+    """ A row of the simulated users table """
+    __slots__ = ('id', 'username', 'email', 'status', 'created_at', 'updated_at')
+
+    def __init__(self, id, username, email, status, created_at, updated_at=None):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.status = status
+        self.created_at = created_at
+        self.updated_at = updated_at
+
+
+def _user_for_wire(user):
+    """
+    The DB hands out `User` rows; clients (and the cache) get plain dicts.
+    """
+    wire = {
+        'id': user.id,
+        'username': user.username,
+        'email': user.email,
+        'status': user.status,
+        'created_at': user.created_at,
+    }
+    if user.updated_at is not None:
+        wire['updated_at'] = user.updated_at
+    return wire
+
 # --- Example Custom Dependency Provider (Simulated Database Interaction) ---
 class DatabaseProvider(DependencyProvider):
     """
@@ -23,37 +99,223 @@ class DatabaseProvider(DependencyProvider):
     In a real service, this would use an ORM or a DB connection pool.
     """
     def __init__(self):
-        self.users = {} # Using a simple dict to simulate a DB table
+        # Column-per-field storage ("struct of arrays"): row `i` of every list
+        # belongs to the same user, `_index` maps user_id -> row
+        self.ids = []
+        self.usernames = []
+        self.emails = []
+        self.statuses = []
+        self.created_at = []
+        self.updated_at = []
+        self._index = {}
         print("DatabaseProvider initialized (simulated)")
 
+    def _row(self, idx):
+        return User(
+            self.ids[idx], self.usernames[idx], self.emails[idx],
+            self.statuses[idx], self.created_at[idx], self.updated_at[idx]
+        )
+
     def get_user(self, user_id):
         print(f"Simulating DB get for user_id: {user_id}")
-        return self.users.get(user_id)
+        idx = self._index.get(user_id)
+        if idx is None:
+            return None
+        return self._row(idx)
 
     def create_user(self, user_id, data):
         print(f"Simulating DB create for user_id: {user_id}")
-        self.users[user_id] = {**data, 'id': user_id, 'created_at': datetime.utcnow().isoformat()}
-        return self.users[user_id]
+        self._index[user_id] = len(self.ids)
+        self.ids.append(user_id)
+        self.usernames.append(data['username'])
+        self.emails.append(data['email'])
+        self.statuses.append(data['status'])
+        self.created_at.append(_dt.utcnow().isoformat())
+        self.updated_at.append(None)
+        return self._row(self._index[user_id])
 
     def update_user_status(self, user_id, status):
          print(f"Simulating DB update status for user_id: {user_id}")
-         if user_id in self.users:
-             self.users[user_id]['status'] = status
-             self.users[user_id]['updated_at'] = datetime.utcnow().isoformat()
-             return self.users[user_id]
+         idx = self._index.get(user_id)
+         if idx is not None:
+             self.statuses[idx] = status
+             self.updated_at[idx] = _dt.utcnow().isoformat()
+             return self._row(idx)
          return None
 
     def delete_user(self, user_id):
          print(f"Simulating DB delete for user_id: {user_id}")
-         if user_id in self.users:
-             del self.users[user_id]
-             return True
-         return False
+         idx = self._index.pop(user_id, None)
+         if idx is None:
+             return False
+         # Swap the last row into the hole so the columns stay dense
+         last = len(self.ids) - 1
+         for column in (self.ids, self.usernames, self.emails,
+                        self.statuses, self.created_at, self.updated_at):
+             column[idx] = column[last]
+             column.pop()
+         if idx != last:
+             self._index[self.ids[idx]] = idx
+         return True
+
+    def bulk_update_status(self, user_ids, status):
+         """ Updates many users at once, returning the ids that were found """
+         print(f"Simulating DB bulk update status for {len(user_ids)} users")
+         # One timestamp for the whole batch
+         now = _dt.utcnow().isoformat()
+         updated = []
+         for user_id in user_ids:
+             idx = self._index.get(user_id)
+             if idx is not None:
+                 self.statuses[idx] = status
+                 self.updated_at[idx] = now
+                 updated.append(user_id)
+         return updated
+
+    def count_by_status(self, status):
+        return self.statuses.count(status)
 
     def get_dependency(self, worker_ctx):
         # Return the provider instance itself or specific methods
         return self
 
+
+class _CancellationBatch:
+    __slots__ = ('items', 'done')
+
+    def __init__(self):
+        self.items = []
+        self.done = Event()
+
+
+class CancellationBuffer(DependencyProvider):
+    """
+    Coalesces concurrent `subscription.cancelled` events across workers so
+    that bursts can be applied to the database with a single bulk write
+    (group commit).
+
+    The first worker to submit opens a batch, yields once so that handlers
+    already delivered can join, then applies it. Every worker waits for its
+    batch to be applied, so its message is only acked once the write has
+    happened and nothing is lost on shutdown.
+    """
+    def __init__(self, max_size=100):
+        self.max_size = max_size
+        self._batch = None
+
+    def setup(self):
+        # Each waiting handler holds a worker, so a batch can't outgrow the pool
+        self.max_size = min(self.max_size, self.container.max_workers)
+
+    def submit(self, user_id, subscription_id, apply):
+        """
+        Adds a cancellation to the open batch and blocks until `apply` has
+        been called with the batch's `(user_id, subscription_id)` items.
+        Errors raised by `apply` are re-raised in every waiting worker.
+        """
+        batch = self._batch
+        leader = batch is None
+        if leader:
+            batch = self._batch = _CancellationBatch()
+
+        batch.items.append((user_id, subscription_id))
+        if len(batch.items) >= self.max_size:
+            # Close the batch so later submissions open a new one
+            self._batch = None
+
+        if not leader:
+            return batch.done.wait()
+
+        sleep(0)
+        if self._batch is batch:
+            self._batch = None
+
+        try:
+            result = apply(batch.items)
+        except BaseException as e:
+            # Also covers Timeout/GreenletExit, so followers never hang
+            batch.done.send_exception(e)
+            raise
+        batch.done.send(result)
+        return result
+
+    def get_dependency(self, worker_ctx):
+        return self
+
+
+class _EventEnqueuer:
+    """ Per-worker handle that queues events with the worker's headers """
+    __slots__ = ('queue', 'headers')
+
+    def __init__(self, queue, headers):
+        self.queue = queue
+        self.headers = headers
+
+    def enqueue(self, event_type, event_data):
+        self.queue.put((event_type, event_data, self.headers))
+
+
+class EventQueue(EventDispatcher):
+    """
+    Publishes events from a background green thread so that the entrypoint
+    raising them doesn't wait on the AMQP round trip.
+    Events go through EventDispatcher's publisher and exchange, carrying the
+    worker context headers (call id stack, context data) captured when
+    they were queued.
+    When the queue is full the caller blocks until there is room, which
+    applies backpressure while keeping events in order.
+    """
+    _STOP = object() # Queued by stop() after the last event
+
+    def __init__(self, maxsize=1024, **kwargs):
+        self.maxsize = maxsize
+        super().__init__(**kwargs)
+
+    def setup(self):
+        super().setup()
+        self.queue = Queue(maxsize=self.maxsize)
+        self.drained = Event()
+        self.draining = False
+
+    def start(self):
+        self.container.spawn_managed_thread(self._drain)
+        self.draining = True
+
+    def stop(self):
+        # Workers have finished by now, so nothing is enqueued after the
+        # sentinel. Wait for the drain thread to publish everything queued
+        # (including an in-flight publish) instead of letting the container
+        # kill it mid-send.
+        if not self.draining:
+            return
+        self.queue.put(self._STOP)
+        self.drained.wait()
+
+    def _drain(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is self._STOP:
+                    return
+                self._publish(*item)
+        finally:
+            self.drained.send()
+
+    def _publish(self, event_type, event_data, headers):
+        try:
+            self.publisher.publish(
+                event_data,
+                exchange=self.exchange,
+                routing_key=event_type,
+                extra_headers=headers
+            )
+        except Exception:
+            # Never let a failed publish kill the drain thread (and the container)
+            log.exception("Failed to publish '%s' event, dropping it", event_type)
+
+    def get_dependency(self, worker_ctx):
+        return _EventEnqueuer(self.queue, self.get_message_headers(worker_ctx))
+
 # --- The Main User Service ---
 class UserService:
     """
@@ -67,19 +329,24 @@ class UserService:
     config = Config() # Accesses config/app.yml
     redis = Redis('user_sessions') # Built-in Redis dependency, 'user_sessions' is the config key
     db = DatabaseProvider() # Our custom (simulated) database provider
-    dispatch = EventDispatcher() # For publishing events
-    notification_service = RpcProxy("sq_notification_service") # To call other services
+    cancellations = CancellationBuffer() # Coalesces subscription cancellations
+    events = EventQueue() # For publishing events (in the background)
+    # To call other services. Arguments are encoded with the `serializer`
+    # from config/app.yml (orjson).
+    notification_service = RpcProxy("sq_notification_service")
     sequoia_metrics = SequoiaMetrics() # For custom metrics (optional)
 
     # --- Entrypoints ---
 
     # 3. RPC Entrypoint: Methods callable by other services
     @rpc
-    @newrelic.agent.background_task() # Optional: New Relic monitoring
+    @_bg # Optional: New Relic monitoring
     def create_user(self, username: str, email: str, password: str):
-        self.log.info(f"Attempting to create user: {username}")
+        self.log.info("Attempting to create user: %s", username)
 
-        user_id = str(uuid.uuid4())
+        # 32-char hex ids (no dashes); existing dashed ids are still accepted
+        # everywhere since ids are treated as opaque strings
+        user_id = _uuid4().hex
         user_data = {
             'username': username,
             'email': email,
@@ -88,8 +355,15 @@ class UserService:
 
         try:
             # Use the database dependency provider
-            created_user = self.db.create_user(user_id, user_data)
-            self.log.info(f"User created successfully: {user_id}")
+            created_user = _user_for_wire(self.db.create_user(user_id, user_data))
+            self.log.info("User created successfully: %s", user_id)
+
+            # Write-through so the first get_user is already a cache hit.
+            # The row is already stored, so a cache failure must not fail the call
+            try:
+                self._cache_user(created_user)
+            except Exception as e:
+                self.log.warning("Failed to cache new user %s: %s", user_id, e)
 
             # 4. Event Publishing: Dispatch an event after creation
             event_payload = {
@@ -98,51 +372,61 @@ class UserService:
                 "email": email,
                 "created_at": created_user['created_at']
             }
-            self.dispatch('user.created', event_payload)
-            self.log.info(f"Dispatched 'user.created' event for {user_id}")
+            self.events.enqueue('user.created', event_payload)
+            self.log.info("Queued 'user.created' event for %s", user_id)
 
             return created_user
 
         except Conflict as e:
-             self.log.warning(f"User creation conflict for {username}: {e}")
+             self.log.warning("User creation conflict for %s: %s", username, e)
              raise # Re-raise the specific conflict
         except Exception as e:
-            self.log.error(f"Failed to create user {username}: {e}", exc_info=True)
+            self.log.error("Failed to create user %s: %s", username, e, exc_info=True)
             raise GenericException(f"Could not create user: {e}") from e
 
     @rpc(expected_exceptions=(NotFound,)) # Declare expected exceptions
-    @newrelic.agent.background_task()
+    @_bg
     def get_user(self, user_id: str):
         """
         Retrieves user details by ID.
         - Attempts to fetch from Redis cache first.
         - Falls back to (simulated) database if not cached.
-        - Caches result in Redis.
-        """
-        self.log.info(f"Attempting to get user: {user_id}")
-        cache_key = f"user:{user_id}"
+        - Caches result in Redis as a hash under `user:{user_id}:profile`.
 
-        # Check cache first
-        cached_user = self.redis.get(cache_key)
+        Cache policy: sliding TTL of 1 hour (refreshed on every hit),
+        invalidated explicitly whenever the user is mutated
+        (delete_user, handle_subscription_cancelled).
+        """
+        self.log.info("Attempting to get user: %s", user_id)
+        cache_key = _user_cache_key(user_id)
+
+        # Check cache first (an empty dict means a miss), refreshing the TTL
+        # in the same round trip
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(cache_key)
+            pipe.expire(cache_key, 3600)
+            cached_user, _ = pipe.execute()
         if cached_user:
-            self.log.info(f"Cache hit for user: {user_id}")
-            return json.loads(cached_user)
+            self.log.info("Cache hit for user: %s", user_id)
+            return cached_user
 
-        self.log.info(f"Cache miss for user: {user_id}. Fetching from DB.")
+        self.log.info("Cache miss for user: %s. Fetching from DB.", user_id)
         # Use the database dependency provider
         user = self.db.get_user(user_id)
 
         if user is None:
-            self.log.warning(f"User not found: {user_id}")
+            self.log.warning("User not found: %s", user_id)
             raise NotFound(f"User with ID {user_id} not found.")
 
+        user = _user_for_wire(user)
+
         # Cache the result (expire after 1 hour)
-        self.redis.set(cache_key, json.dumps(user), ex=3600)
-        self.log.info(f"User fetched from DB and cached: {user_id}")
+        self._cache_user(user)
+        self.log.info("User fetched from DB and cached: %s", user_id)
         return user
 
-    @rpc
-    @newrelic.agent.background_task()
+    @rpc(expected_exceptions=(NotFound,))
+    @_bg
     def delete_user(self, user_id: str):
         """
         Deletes a user.
@@ -150,68 +434,103 @@ class UserService:
         - Calls the NotificationService via RpcProxy.
         - Publishes a 'user.deleted' event.
         """
-        self.log.info(f"Attempting to delete user: {user_id}")
+        self.log.info("Attempting to delete user: %s", user_id)
 
-        user = self.get_user(user_id) # Reuse get_user to ensure existence
+        # Check existence against the DB directly; going through get_user would
+        # also re-cache a profile that is about to be deleted
+        user = self.db.get_user(user_id)
+        if user is None:
+            self.log.warning("User not found: %s", user_id)
+            raise NotFound(f"User with ID {user_id} not found.")
 
         # Use the database dependency provider
         deleted = self.db.delete_user(user_id)
 
         if deleted:
-            self.log.info(f"User deleted successfully from DB: {user_id}")
+            self.log.info("User deleted successfully from DB: %s", user_id)
 
             # 5. RPC Call: Call another service
+            # Fire the call asynchronously so its round trip overlaps with the
+            # event dispatch and cache invalidation below; collect the reply last.
+            # Publishing can fail right away (e.g. UnknownService), which must
+            # not skip the event and cache invalidation for an already deleted user.
             try:
-                self.notification_service.send_goodbye_email(user['email'], user['username'])
-                self.log.info(f"Notified NotificationService about deletion of {user_id}")
-            except RemoteError as e:
-                # Log RPC errors but don't necessarily fail the whole operation
-                self.log.error(f"Failed to call notification_service for user {user_id}: {e}")
+                goodbye_reply = self.notification_service.send_goodbye_email.call_async(
+                    user.email, user.username
+                )
             except Exception as e:
-                 self.log.error(f"Unexpected error calling notification_service for user {user_id}: {e}", exc_info=True)
-
+                goodbye_reply = None
+                self.log.error("Unexpected error calling notification_service for user %s: %s", user_id, e, exc_info=True)
 
             # Publish event
-            self.dispatch('user.deleted', {"id": user_id})
-            self.log.info(f"Dispatched 'user.deleted' event for {user_id}")
+            self.events.enqueue('user.deleted', {"id": user_id})
+            self.log.info("Queued 'user.deleted' event for %s", user_id)
 
             # Clear cache
-            cache_key = f"user:{user_id}"
+            cache_key = _user_cache_key(user_id)
             self.redis.delete(cache_key)
-            self.log.info(f"Cache cleared for user: {user_id}")
+            self.log.info("Cache cleared for user: %s", user_id)
+
+            if goodbye_reply is not None:
+                try:
+                    goodbye_reply.result()
+                    self.log.info("Notified NotificationService about deletion of %s", user_id)
+                except RemoteError as e:
+                    # Log RPC errors but don't necessarily fail the whole operation
+                    self.log.error("Failed to call notification_service for user %s: %s", user_id, e)
+                except Exception as e:
+                     self.log.error("Unexpected error calling notification_service for user %s: %s", user_id, e, exc_info=True)
 
             return {"status": "deleted", "id": user_id}
         else:
-            # This case shouldn't happen if get_user succeeded, but included for completeness
-            self.log.error(f"Failed to delete user {user_id} from DB (already gone?)")
+            # This case shouldn't happen if the lookup above succeeded, but included for completeness
+            self.log.error("Failed to delete user %s from DB (already gone?)", user_id)
             raise NotFound(f"User with ID {user_id} could not be deleted (not found).")
 
 
+    def _cache_user(self, user):
+        """ Stores a wire-format user as a hash, expiring after 1 hour """
+        cache_key = _user_cache_key(user['id'])
+        with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hset(cache_key, mapping=user)
+            pipe.expire(cache_key, 3600)
+            pipe.execute()
+
     # 6. Event Handler Entrypoint: React to events from other services
     @event_handler("sq_subscription_service", "subscription.cancelled", handler_type=BROADCAST)
-    @newrelic.agent.background_task()
+    @_bg
     def handle_subscription_cancelled(self, payload):
         """
         Handles the event when a subscription is cancelled.
-        Updates the user status in the (simulated) database.
+        The status update is coalesced with other concurrent cancellations
+        and applied in bulk before this handler returns.
         """
         user_id = payload.get("user_id")
         subscription_id = payload.get("subscription_id")
-        self.log.info(f"Received subscription.cancelled event for user {user_id}, sub {subscription_id}")
+        self.log.info("Received subscription.cancelled event for user %s, sub %s", user_id, subscription_id)
 
         if not user_id:
             self.log.warning("Received subscription.cancelled event without user_id.")
             return
 
+        self.cancellations.submit(user_id, subscription_id, self._apply_cancellations)
+
+    def _apply_cancellations(self, pending):
         # Use the database dependency provider
-        updated_user = self.db.update_user_status(user_id, "inactive_subscription")
+        updated = set(self.db.bulk_update_status(
+            [user_id for user_id, _ in pending], "inactive_subscription"
+        ))
 
-        if updated_user:
-            self.log.info(f"Updated status for user {user_id} due to cancelled subscription {subscription_id}")
+        if updated:
+            # Drop the stale cached profiles rather than waiting for the TTL
+            self.redis.delete(*[_user_cache_key(user_id) for user_id in updated])
             # Optionally dispatch another event like 'user.status.updated'
-            # self.dispatch('user.status.updated', updated_user)
-        else:
-             self.log.warning(f"Could not find user {user_id} to update status after subscription cancellation.")
+
+        for user_id, subscription_id in pending:
+            if user_id in updated:
+                self.log.info("Updated status for user %s due to cancelled subscription %s", user_id, subscription_id)
+            else:
+                 self.log.warning("Could not find user %s to update status after subscription cancellation.", user_id)
 
     # 7. HTTP Entrypoint (less common in core services, often in gateways)
     # Usually requires a separate http runner or integrated setup.